@@ -3,13 +3,14 @@
 
 from __future__ import annotations
 
+import functools
 import os.path
 import pathlib
 import subprocess
 import typing
 import warnings
 
-from typing import Any, Dict, List, Optional, Set, Type, Union
+from typing import Any, Dict, List, Optional, Set, Tuple, Type, Union
 
 from . import ninja
 
@@ -28,6 +29,13 @@ class DependencyError(Exception):
 class Dependency():
     NAME: Optional[str] = None
 
+    _REGISTRY: Dict[str, Type[Dependency]] = {}
+
+    def __init_subclass__(cls, **kwargs: Any) -> None:
+        super().__init_subclass__(**kwargs)
+        if cls.NAME:
+            Dependency._REGISTRY[cls.NAME] = cls
+
     def __init__(self, *args: Any, **kwargs: Any) -> None:
         if not self.NAME:
             raise ValueError(f"Dependency doesn't have a name: {self.__class__.__name__}")
@@ -45,10 +53,9 @@ class Dependency():
 
     @classmethod
     def class_from_name(cls, name: str) -> Type[Dependency]:
-        for subclass in cls.__subclasses__():
-            if subclass.NAME == name:
-                return subclass
-        raise ValueError(f'Could not find dependency: {name}')
+        if name not in cls._REGISTRY:
+            raise ValueError(f'Could not find dependency: {name}')
+        return cls._REGISTRY[name]
 
     @classmethod
     def fetch_submodule(cls) -> None:
@@ -99,7 +106,7 @@ class Dependency():
         objs: List[str] = []
         for file in self.source:
             objs += nw.cc_abs(file, variables=[
-                ('c_include_flags', list(c_include_flags)),
+                ('c_include_flags', sorted(c_include_flags)),
             ])
         nw.newline()
 
@@ -120,10 +127,10 @@ class Dependency():
     def optional_dependencies(self) -> Set[str]:
         return set(self._optional_dependencies)
 
-    @property
-    def source(self) -> Set[str]:
-        ''' Source files '''
-        return {str(self.base_path / path) for path in self._source}
+    @functools.cached_property
+    def source(self) -> Tuple[str, ...]:
+        ''' Source files, deduplicated in a stable order '''
+        return tuple(dict.fromkeys(str(self.base_path / path) for path in self._source))
 
     @property
     def include(self) -> Set[str]:
@@ -5,46 +5,37 @@ import os
 import pathlib
 import typing
 
-from typing import Any, List, Optional, Union
+from typing import Any, List, Union
 
 import ninja_syntax
 
 
 class Writer(ninja_syntax.Writer):  # type: ignore
-    def __init__(
-        self,
-        *args: Any,
-        toolchain: Optional[str],
-        **kwargs: Any
-    ) -> None:
-        super().__init__(*args, **kwargs)
-        self._toolchain = toolchain
-
     # helpers
+    # these generate ninja paths, not filesystem paths, so we can simply join
+    # them with '/' instead of going through os.path.join
 
-    src_dir = os.path.join('$root', 'src')
+    src_dir = '$root/src'
 
     @classmethod
     def src(cls, *files: str) -> str:
-        return os.path.join(cls.src_dir, *files)
+        return '/'.join((cls.src_dir, *files))
 
     @classmethod
     def root(cls, *files: str) -> str:
-        return os.path.join('$root', *files)
+        return '/'.join(('$root', *files))
 
     @classmethod
     def built(cls, file: Union[str, pathlib.Path]) -> str:
-        return os.path.join('$builddir', str(file))
+        return f'$builddir/{file}'
 
     @classmethod
     def remove_ext(cls, file: str) -> str:
-        return file.split('.')[0]
+        return os.path.splitext(file)[0]
 
     @classmethod
     def extension(cls, file: str, ext: str) -> str:
-        return cls.built(os.path.join(
-            'out', '.'.join(filter(None, [file, ext]))
-        ))
+        return cls.built(f'out/{file}.{ext}' if ext else f'out/{file}')
 
     def cc(self, file: str, **kwargs: Any) -> List[str]:
         return typing.cast(List[str], self.build(
@@ -61,6 +52,3 @@ class Writer(ninja_syntax.Writer):  # type: ignore
             self.root(file),
             **kwargs,
         )
-
-    def tool(self, name: str) -> str:
-        return '-'.join(filter(None, [self._toolchain, name]))
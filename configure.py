@@ -6,30 +6,43 @@ from __future__ import annotations
 
 import argparse
 import functools
+import importlib.util
+import io
 import os
-import shutil
-import subprocess
 import sys
-import traceback
 import warnings
 
-from typing import Any, Dict, List, MutableMapping, Optional, Set, TextIO, Type, Union
+
+# only needed for type checking, avoid importing typing at runtime
+# (type checkers special-case the exact name TYPE_CHECKING, don't rename it)
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import Any, Dict, List, MutableMapping, Optional, TextIO, Tuple, Type, Union
+
+    import build_system.dependencies
+    import build_system.ninja
 
 
 _MIN_PYTHON_VERSION = (3, 9)
 
 
+_IS_TTY = sys.stdout.isatty()
+
 # disable colors if we're not in a TTY
-if sys.stdout.isatty():
+if _IS_TTY:
     _RESET = '\33[0m'
     _DIM = '\33[2m'
     _RED = '\33[91m'
     _CYAN = '\33[96m'
+    _YELLOW = '\33[93m'
 else:
     _RESET = ''
     _DIM = ''
     _RED = ''
     _CYAN = ''
+    _YELLOW = ''
+
+_WARNING_PREFIX = f'{_YELLOW}WARNING{_RESET}'
 
 
 def _error(msg: str, code: int = 1) -> None:
@@ -40,6 +53,13 @@ def _error(msg: str, code: int = 1) -> None:
     exit(code)
 
 
+def _dash(*parts: Optional[str]) -> str:
+    '''
+    Joins the non-empty parts with dashes
+    '''
+    return '-'.join([part for part in parts if part])
+
+
 if sys.version_info < _MIN_PYTHON_VERSION:
     _error(
         f'Unsupported Python version: {".".join(map(str, sys.version_info[:3]))}... '
@@ -57,16 +77,13 @@ except ImportError:
         'You can install it with: pip install toml'
     )
 
-try:
-    import ninja_syntax  # noqa: F401
-except ImportError:
+# ninja_syntax is only imported by build_system.ninja when writing the build
+# file, here we just check that it is available
+if importlib.util.find_spec('ninja_syntax') is None:
     _error(
         'Missing ninja_syntax dependency!\n'
         'You can install it with: pip install ninja_syntax'
     )
-else:
-    import build_system.dependencies
-    import build_system.ninja
 
 
 # overide default warning handler for a nice CLI
@@ -84,10 +101,7 @@ def _showwarning(
 
     We override warnings.showwarning with this to match our CLI
     '''
-    prefix = 'WARNING'
-    if sys.stdout.isatty():
-        prefix = '\33[93m' + prefix + '\33[0m'
-    print('{} {}'.format(prefix, str(message)))
+    print(_WARNING_PREFIX, message)
 
 
 warnings.showwarning = _showwarning
@@ -104,18 +118,38 @@ TARGETS = [
     if target.endswith('.toml')
 ]
 
-# find target config options, for the ones that support configs
-TARGET_CONFIGS: Dict[str, List[str]] = {}
-for _target in TARGETS:
-    # find the targets that have `has-config` in their config, and populate the
-    # possible config choices with the options available in src/targets/{_target}/config
-    _target_config = toml.load(os.path.join(_configs_targets, f'{_target}.toml'))
-    if 'has-config' in _target_config:
-        _configs_dir = os.path.join(_root, 'src', 'targets', _target, 'config')
-        TARGET_CONFIGS[_target] = [
-            config.split('.')[0] for config in os.listdir(_configs_dir)
-            if config.endswith('.h')
-        ]
+
+def _target_configs(target: str) -> Optional[List[str]]:
+    '''
+    Finds the target config options, if the target supports configs
+    '''
+    # targets that have `has-config` in their config have the possible config
+    # choices in src/targets/{target}/config
+    target_config = toml.load(os.path.join(_configs_targets, f'{target}.toml'))
+    if 'has-config' not in target_config:
+        return None
+    configs_dir = os.path.join(_root, 'src', 'targets', target, 'config')
+    return [
+        config.split('.')[0] for config in os.listdir(configs_dir)
+        if config.endswith('.h')
+    ]
+
+
+def _add_target_arguments(parser: argparse.ArgumentParser, target: str) -> None:
+    '''
+    Registers the target specific arguments in the target parser
+    '''
+    target_configs = _target_configs(target)
+    if target_configs is not None:
+        parser.add_argument(
+            '--config',
+            '-c',
+            type=str,
+            metavar='CONFIG',
+            choices=target_configs,
+            help='device configuration name',
+            required=True,
+        )
 
 
 class BuildError(Exception):
@@ -211,8 +245,6 @@ class BuildSystemBuilder():
         self._base_config = toml.load(config_path)
 
     def _populate_source(self) -> None:
-        self._source: Set[str] = set()
-
         # common
         base_src = self._base_config.get('source', [])
 
@@ -233,13 +265,14 @@ class BuildSystemBuilder():
         # TODO: select between main.c and bootloader.c
         target_src.append('main.c')
 
-        self._source.update([
+        # deduplicate while keeping the order stable between runs
+        self._source: List[str] = list(dict.fromkeys([
             file.replace('/', os.path.sep) for file in base_src
         ] + [
             os.path.join('platform', self._family, file) for file in family_src
         ] + [
             os.path.join('targets', self._target, file) for file in target_src
-        ])
+        ]))
 
     def _populate_linker(self) -> None:
         if self._family_config.get('has-linker', True) is False:  # default to true
@@ -304,8 +337,15 @@ class BuildSystemBuilder():
                     f'Specified `{self._toolchain}` as the cross toolchain, '
                     f'did you mean `{self._toolchain[:-1]}`?'
                 )
-        for tool in self._REQUIRED_TOOLS:
-            name = '-'.join(filter(None, [self._toolchain, tool]))
+
+        import shutil
+
+        self._tools = {
+            tool: _dash(self._toolchain, tool)
+            for tool in self._REQUIRED_TOOLS
+        }
+
+        for name in self._tools.values():
             if shutil.which(name) is None:
                 _error(f'Invalid toolchain: {name} not found')
 
@@ -323,6 +363,8 @@ class BuildSystemBuilder():
             self._generate_hex = True
 
     def _populate_dependencies(self) -> None:
+        import build_system.dependencies
+
         self._dependencies: Dict[str, build_system.dependencies.Dependency] = {}
 
         dependencies = self._family_config.get('dependencies', {})
@@ -347,7 +389,7 @@ class BuildSystemBuilder():
 
     def _ninja_write_variables(self, nw: build_system.ninja.Writer) -> None:
         linker_args = [
-            '-L{}'.format(os.path.join('$root', self._linker_dir)),
+            f'-L{nw.root(self._linker_dir)}',
             f'-T{self._linker}',
         ] if self._linker else []
 
@@ -355,10 +397,10 @@ class BuildSystemBuilder():
         nw.newline()
         nw.variable('root', self._root)
         nw.variable('builddir', self._builddir)
-        nw.variable('cc', nw.tool('gcc'))
-        nw.variable('ar', nw.tool('ar'))
-        nw.variable('objcopy', nw.tool('objcopy'))
-        nw.variable('size', nw.tool('size'))
+        nw.variable('cc', self._tools['gcc'])
+        nw.variable('ar', self._tools['ar'])
+        nw.variable('objcopy', self._tools['objcopy'])
+        nw.variable('size', self._tools['size'])
         nw.variable('c_flags', self._options['c_flags'])
         nw.variable('c_include_flags', ' '.join([
             f'-I{nw.src_dir}',
@@ -391,7 +433,9 @@ class BuildSystemBuilder():
         nw.newline()
         nw.rule(
             'link',
-            command='$cc -o $out $in $ld_flags',
+            command='$cc -o $out @$out.rsp $ld_flags',
+            rspfile='$out.rsp',
+            rspfile_content='$in',
             description='LINK $out',
         )
         nw.newline()
@@ -412,96 +456,184 @@ class BuildSystemBuilder():
             )
             nw.newline()
 
+    def _ninja_write_regenerate(self, nw: build_system.ninja.Writer, file: str) -> None:
+        build_system_dir = os.path.join(_root, 'build_system')
+        inputs = [
+            nw.root(self._this_file_name),
+            nw.root('config', 'base.toml'),
+            nw.root('config', 'targets', f'{self._target}.toml'),
+        ]
+        if 'family' in self._target_config:
+            inputs.append(nw.root('config', 'families', f'{self._family}.toml'))
+        inputs += [
+            nw.root('build_system', name) for name in sorted(os.listdir(build_system_dir))
+            if name.endswith('.py')
+        ]
+
+        nw.comment('regenerate build file when the configuration changes')
+        nw.newline()
+        nw.rule(
+            'configure',
+            command='./config.status',
+            generator=True,
+            restat=True,
+            description='CONFIGURE $out',
+        )
+        nw.newline()
+        nw.build(file, 'configure', implicit=inputs)
+        nw.newline()
+
+    @staticmethod
+    def _replace_file(file: str, content: str) -> None:
+        '''
+        Atomically replaces the contents of a file, if they changed
+
+        Leaving the file untouched keeps its mtime, so ninja does not consider
+        it modified, and writing to a temporary file first makes sure we never
+        leave a truncated file behind.
+        '''
+        try:
+            with open(file) as f:
+                if f.read() == content:
+                    return
+        except FileNotFoundError:
+            pass
+
+        tmp_file = f'{file}.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                f.write(content)
+            os.replace(tmp_file, file)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+
     def write_ninja(self, file: str = 'build.ninja') -> None:  # noqa: C901
-        with open(file, 'w') as f:
-            nw = build_system.ninja.Writer(f, toolchain=self._toolchain, width=160)
-
-            self._ninja_write_header(nw)
-            self._ninja_write_variables(nw)
-            self._ninja_write_rules(nw)
-
-            objs: List[str] = []
-
-            # optional config argument
-            config: Optional[str] = None
-            if self._config:
-                config = nw.src('targets', self._target, 'config', f'{self._config}.h')
-
-            # build dependencies
-            for name, dep in self._dependencies.items():
-                objs += dep.write_ninja(
-                    nw,
-                    self._dependencies,
-                    nw.src('targets', self._target),
-                    config,
-                )
+        import build_system.ninja
+
+        # generate the whole file in memory so that it is written in one go
+        buf = io.StringIO()
+        nw = build_system.ninja.Writer(buf, width=160)
+
+        self._ninja_write_header(nw)
+        self._ninja_write_variables(nw)
+        self._ninja_write_rules(nw)
+        self._ninja_write_regenerate(nw, file)
+
+        objs: List[str] = []
+
+        # optional config argument
+        config: Optional[str] = None
+        if self._config:
+            config = nw.src('targets', self._target, 'config', f'{self._config}.h')
+
+        # build dependencies
+        for name, dep in self._dependencies.items():
+            objs += dep.write_ninja(
+                nw,
+                self._dependencies,
+                nw.src('targets', self._target),
+                config,
+            )
 
-            # build our source
-            nw.comment('target objects')
-            nw.newline()
-            for file in self._source:
-                objs += nw.cc(file)
-            nw.newline()
+        # build our source
+        nw.comment('target objects')
+        nw.newline()
+        for source in self._source:
+            objs += nw.cc(source)
+        nw.newline()
+
+        # build output objects
+        nw.comment('target')
+        nw.newline()
+        out_name = self._target_config.get('out-name', _dash(
+            'openinput',
+            self._target,
+            self.version.replace('.', '-'),
+            'dirty' if self.dirty else None,
+        ))
+        out = nw.extension(out_name, self._bin_extension)
+        if self._target_config.get('is-shared-library') is True:
+            nw.build(out, 'link', objs, variables={
+                'ld_flags': self._options['ld_flags'] + ['-shared']
+            })
+        else:
+            nw.build(out, 'link', objs)
+        nw.newline()
 
-            # build output objects
-            nw.comment('target')
+        if self._generate_bin:
+            nw.build(nw.extension(out_name, 'bin'), 'bin', out)
             nw.newline()
-            out_name = self._target_config.get('out-name', '-'.join(filter(None, [
-                'openinput',
-                self._target,
-                self.version.replace('.', '-'),
-                'dirty' if self._is_git_dirty() else None,
-            ])))
-            out = nw.extension(out_name, self._bin_extension)
-            if self._target_config.get('is-shared-library') is True:
-                nw.build(out, 'link', objs, variables={
-                    'ld_flags': self._options['ld_flags'] + ['-shared']
-                })
-            else:
-                nw.build(out, 'link', objs)
+        if self._generate_hex:
+            nw.build(nw.extension(out_name, 'hex'), 'hex', out)
             nw.newline()
 
-            if self._generate_bin:
-                nw.build(nw.extension(out_name, 'bin'), 'bin', out)
-                nw.newline()
-            if self._generate_hex:
-                nw.build(nw.extension(out_name, 'hex'), 'hex', out)
-                nw.newline()
+        self._replace_file(file, buf.getvalue())
 
-    @staticmethod
-    def _is_git_dirty() -> Optional[bool]:
-        try:
-            return bool(subprocess.check_output(['git', 'diff', '--stat']).decode().strip())
-        except FileNotFoundError:
-            return None
+    def write_config_status(self, argv: List[str], file: str = 'config.status') -> None:
+        '''
+        Writes a script that re-runs configure with the same arguments
+
+        It is used by ninja to regenerate the build file.
+        '''
+        import shlex
+
+        command = [sys.executable, os.path.join(self._root, self._this_file_name), *argv]
+        self._replace_file(file, f'#!/bin/sh\nexec {shlex.join(command)}\n')
+        os.chmod(file, 0o755)
 
     @staticmethod
-    def calculate_version() -> str:
+    @functools.cache
+    def _git_describe() -> Tuple[str, Optional[bool]]:
+        '''
+        Calculates the version and the dirty state of the working tree
+
+        Everything we need comes from a single ``git describe`` call, we only
+        need a second call to count the commits when there are no tags.
+        '''
+        import subprocess
+
         try:
-            tag_commit = subprocess.check_output(['git', 'rev-list', '--tags', '--max-count=1']).decode().strip()
-            if tag_commit:
-                # if there is a tag, use git describe
-                return subprocess.check_output(['git', 'describe']).decode().strip()
-            # fallback to r{commit count}.{shortened commit id}
-            return 'r{}.{}'.format(
-                subprocess.check_output(['git', 'rev-list', '--count', 'HEAD']).decode().strip(),
-                subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).decode().strip(),
-            )
+            describe = subprocess.check_output(['git', 'describe', '--always', '--long', '--dirty']).decode().strip()
+            dirty = describe.endswith('-dirty')
+            if dirty:
+                describe = describe[:-len('-dirty')]
+            # {tag}-{commits since tag}-g{shortened commit id}
+            parts = describe.rsplit('-', 2)
+            if len(parts) == 3:
+                tag, distance, _ = parts
+                return (tag if distance == '0' else describe), dirty
+            # no tags, fallback to r{commit count}.{shortened commit id}
+            count = subprocess.check_output(['git', 'rev-list', '--count', 'HEAD']).decode().strip()
+            return f'r{count}.{describe}', dirty
         except FileNotFoundError:
-            return 'UNKNOWN'
+            return 'UNKNOWN', None
+
+    @classmethod
+    def _is_git_dirty(cls) -> Optional[bool]:
+        return cls._git_describe()[1]
+
+    @classmethod
+    def calculate_version(cls) -> str:
+        return cls._git_describe()[0]
 
     @functools.cached_property
     def version(self) -> str:
         return self.calculate_version()
 
+    @property
+    def dirty(self) -> Optional[bool]:
+        return self._is_git_dirty()
+
     @functools.cached_property
     def full_version(self) -> str:
-        return f'{self.version}.dirty' if self._is_git_dirty() else self.version
+        return f'{self.version}.dirty' if self.dirty else self.version
 
     def print_summary(self) -> None:
         print(
             f'openinput {_CYAN}{self.version}{_RESET}' +
-            (f' {_RED}(dirty){_RESET}' if self._is_git_dirty() else ''),
+            (f' {_RED}(dirty){_RESET}' if self.dirty else ''),
             end='\n\n'
         )
 
@@ -577,32 +709,37 @@ if __name__ == '__main__':
         metavar='TARGET',
     )
 
-    # register targets and thier arguments
-    for target in TARGETS:
-        target_parser = target_subparsers.add_parser(target)
-        if target in TARGET_CONFIGS:
-            target_parser.add_argument(
-                '--config',
-                '-c',
-                type=str,
-                metavar='CONFIG',
-                choices=TARGET_CONFIGS[target],
-                help='device configuration name',
-                required=True,
-            )
+    # register targets
+    target_parsers = {
+        target: target_subparsers.add_parser(target)
+        for target in TARGETS
+    }
 
-    args = parser.parse_args()
+    # registering the target arguments requires loading the target config, so
+    # we only do it for the targets that show up in the command line
+    argv = sys.argv[1:]
+    registered_targets = [target for target in TARGETS if target in argv]
+    for target in registered_targets:
+        _add_target_arguments(target_parsers[target], target)
+
+    args = parser.parse_args(argv)
 
     if not args.target:
         # ask for target if it was not specified
-        args = parser.parse_args([_ask_target()])
+        argv = [_ask_target()]
+        if argv[0] not in registered_targets:
+            _add_target_arguments(target_parsers[argv[0]], argv[0])
+        args = parser.parse_args(argv)
 
     try:
         builder = BuildSystemBuilder(**vars(args))
         builder.print_summary()
         builder.write_ninja()
+        builder.write_config_status(argv)
         print("\nbuild.ninja written! Call 'ninja' to compile...")
     except Exception as e:
+        import traceback
+
         print()
         print(_DIM + traceback.format_exc() + _RESET)
         _error(str(e))